@@ -32,144 +32,14 @@ from html.parser import HTMLParser
 from pathlib import Path
 from random import choice
 from subprocess import PIPE, Popen
-from typing import NamedTuple
+from typing import Any, NamedTuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
-# Unpacker for Dean Edward's p.a.c.k.e.r, a part of javascript beautifier
-# by Einar Lielmanis <einar@beautifier.io>
-# written by Stefano Sanfilippo <a.little.coder@gmail.com>
-
-
-class UnpackingError(Exception):
-    """Badly packed source or general error. Argument is a meaningful description."""
-
-    pass
-
-
-def unpack(source: str) -> str:
-    """Unpack P.A.C.K.E.R packed js code."""
-    mystr = re.search(
-        r"eval[ ]*\([ ]*function[ ]*\([ ]*p[ ]*,[ ]*a[ ]*,[ ]*c["
-        " ]*,[ ]*k[ ]*,[ ]*e[ ]*,[ ]*",
-        source,
-    )
-    if not mystr:
-        raise UnpackingError("not a P.A.C.K.E.R code")
-
-    begin_offset = mystr.start()
-    beginstr = source[:begin_offset]
-    source_end = source[begin_offset:]
-    if source_end.split("')))", 1)[0] == source_end:
-        try:
-            endstr = source_end.split("}))", 1)[1]
-        except IndexError:
-            endstr = ""
-    else:
-        endstr = source_end.split("')))", 1)[1]
-    payload, symtab, radix, count = _filterargs(source)
-
-    if count != len(symtab):
-        raise UnpackingError("malformed P.A.C.K.E.R symtab")
-
-    try:
-        unbase = Unbaser(radix)
-    except TypeError:
-        raise UnpackingError("unknown P.A.C.K.E.R encoding")
-
-    def lookup(match):
-        """Look up symbols in the synthetic symtab."""
-        word = match.group(0)
-        return symtab[unbase(word)] or word
-
-    payload = payload.replace("\\\\", "\\").replace("\\'", "'")
-    source = re.sub(r"\b\w+\b", lookup, payload, flags=re.ASCII)
-    return _replacestrings(source, beginstr, endstr)
-
-
-def _filterargs(source: str) -> tuple[str, list[str], int, int]:
-    """Juice from a source file the four args needed by decoder."""
-    juicers = [
-        (r"}\('(.*)', *(\d+|\[\]), *(\d+), *'(.*)'\.split\('\|'\), *(\d+), *(.*)\)\)"),
-        (r"}\('(.*)', *(\d+|\[\]), *(\d+), *'(.*)'\.split\('\|'\)"),
-    ]
-    for juicer in juicers:
-        args = re.search(juicer, source, re.DOTALL)
-        if args:
-            a = args.groups()
-            if a[1] == "[]":
-                a = list(a)
-                a[1] = 62
-                a = tuple(a)
-            try:
-                return a[0], a[3].split("|"), int(a[1]), int(a[2])
-            except ValueError:
-                raise UnpackingError("corrupted P.A.C.K.E.R data")
-
-    # Could not find a satisfying regex
-    raise UnpackingError(
-        "could not make sense of P.A.C.K.E.R data (unexpected code structure)"
-    )
-
-
-def _replacestrings(source: str, beginstr: str, endstr: str) -> str:
-    """Strip string lookup table (list) and replace values in source."""
-    match = re.search(r'var *(_\w+)\=\["(.*?)"\];', source, re.DOTALL)
-
-    if match:
-        varname, strings = match.groups()
-        startpoint = len(match.group(0))
-        lookup = strings.split('","')
-        variable = "%s[%%d]" % varname
-        for index, value in enumerate(lookup):
-            source = source.replace(variable % index, '"%s"' % value)
-        return source[startpoint:]
-    return beginstr + source + endstr
-
-
-class Unbaser(object):
-    """Functor for a given base. Will efficiently convert strings to natural numbers."""
-
-    ALPHABET = {
-        62: "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ",
-        95: (
-            " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-            "[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~"
-        ),
-    }
-
-    def __init__(self, base: int) -> None:
-        self.base = base
-
-        # Fill elements 37...61, if necessary
-        if 36 < base < 62:
-            if not hasattr(self.ALPHABET, self.ALPHABET[62][:base]):
-                self.ALPHABET[base] = self.ALPHABET[62][:base]
-        # If base can be handled by int() builtin, let it do it for us
-        if 2 <= base <= 36:
-            self.unbase = lambda string: int(string, base)
-        else:
-            # Build conversion dictionary cache
-            try:
-                self.dictionary = dict(
-                    (cipher, index) for index, cipher in enumerate(self.ALPHABET[base])
-                )
-            except KeyError:
-                raise TypeError("unsupported base encoding")
-
-            self.unbase = self._dictunbaser
-
-    def __call__(self, string: str) -> int:
-        return self.unbase(string)
-
-    def _dictunbaser(self, string: str) -> int:
-        """Decode a value to an integer."""
-        ret = 0
-        for index, cipher in enumerate(string[::-1]):
-            ret += (self.base**index) * self.dictionary[cipher]
-        return ret
-
+from unpacker import unpack
 
 user_agents = [
     "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36",
@@ -188,6 +58,12 @@ user_agents = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36 OPR/118.0.0.0",
 ]
 
+_PIX_SUFFIX_RE = re.compile(
+    r'pix="(?P<pix>.*?)".*?pix\+pvalue\[i\]\+\'(?P<suffix>.*?)\'', re.DOTALL
+)
+_PVALUE_RE = re.compile(r'"(/.*?\.jpg)"')
+_MANGABZ_VAR_RE = re.compile(r"var\s+(MANGABZ_\w+|COMIC_MID)\s*=\s*([^;]*);")
+
 
 class ChapterInfo(NamedTuple):
     href: str
@@ -204,14 +80,36 @@ class FileInfo(NamedTuple):
     file: Path
 
 
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """`HTTPAdapter` with a default timeout.
+
+    requests waits forever by default, so an address that silently drops packets
+    (e.g. a broken IPv6 route) would stall a download instead of falling back to
+    the next address or being retried.
+    """
+
+    def __init__(self, *args: Any, timeout: tuple[float, float], **kwargs: Any) -> None:
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(
+        self, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
 class MetadataParser(HTMLParser):
     """Parse HTML to fetch metadata."""
 
-    _is_title = False
-    _is_chap_name = False
-    _title = ""
-    _chap_href = ""
-    _chap_list: list[ChapterInfo] = []
+    def __init__(self) -> None:
+        super().__init__()
+        self._is_title = False
+        self._is_chap_name = False
+        self._title = ""
+        self._chap_href = ""
+        self._chap_list: list[ChapterInfo] = []
 
     def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
         attrs_dict = {t[0]: t[1] for t in attrs}
@@ -228,7 +126,7 @@ class MetadataParser(HTMLParser):
             self._title = data.strip()
             self._is_title = False
         elif self._is_chap_name:
-            self._chap_list.insert(0, ChapterInfo(self._chap_href, data.strip()))
+            self._chap_list.append(ChapterInfo(self._chap_href, data.strip()))
             self._is_chap_name = False
 
     @property
@@ -237,7 +135,8 @@ class MetadataParser(HTMLParser):
 
     @property
     def chap_list(self) -> list[ChapterInfo]:
-        return self._chap_list
+        # Chapters are listed from the newest to the oldest.
+        return self._chap_list[::-1]
 
 
 def parse_range(string: str, info: MangaInfo) -> list[int]:
@@ -256,26 +155,19 @@ def parse_range(string: str, info: MangaInfo) -> list[int]:
     """
     if len(string) == 0:
         return list(range(len(info.chapters)))
-    result = []
+    result: set[int] = set()
     for part in string.split(","):
         if "-" in part:
             hyphen = part.find("-")
-            for i in range(int(part[:hyphen]), int(part[hyphen + 1 :]) + 1):
-                if i not in result:
-                    result.append(i)
+            result.update(range(int(part[:hyphen]), int(part[hyphen + 1 :]) + 1))
         else:
-            if (i := int(part)) not in result:
-                result.append(i)
-    result = [i - 1 for i in result if 1 <= i <= len(info.chapters)]
-    return sorted(result)
+            result.add(int(part))
+    return sorted(i - 1 for i in result if 1 <= i <= len(info.chapters))
 
 
-def find_mangabz_var(name: str, string: str) -> str:
-    """Find a variable named `name` in `string`."""
-    start = string.find(f"var {name}")
-    a = string.find("=", start) + 1
-    b = string.find(";", start)
-    return string[a:b].strip(" '\"")
+def find_mangabz_vars(string: str) -> dict[str, str]:
+    """Find all variables like `MANGABZ_*` and `COMIC_MID` in `string`."""
+    return {k: v.strip(" '\"") for k, v in _MANGABZ_VAR_RE.findall(string)}
 
 
 def get_manga_info(
@@ -284,18 +176,13 @@ def get_manga_info(
     """Get manga metadata."""
     response = session.get(f"https://mangabz.com/{manga}/")
     response.raise_for_status()
+    response.encoding = "utf-8"
+    if is_chapter:
+        manga_title = find_mangabz_vars(response.text)["MANGABZ_CTITLE"]
+        return MangaInfo(manga_title, [ChapterInfo(manga, manga_title)])
     parser = MetadataParser()
     parser.feed(response.text)
-    if is_chapter:
-        manga_title = find_mangabz_var("MANGABZ_CTITLE", response.text)
-    else:
-        manga_title = parser.title
-    chap_list: list[ChapterInfo] = []
-    if is_chapter:
-        chap_list.append(ChapterInfo(manga, manga_title))
-    else:
-        chap_list.extend(parser.chap_list)
-    return MangaInfo(manga_title, chap_list)
+    return MangaInfo(parser.title, parser.chap_list)
 
 
 def list_chapters(info: MangaInfo) -> None:
@@ -330,20 +217,70 @@ def list_chapters(info: MangaInfo) -> None:
 
 
 def _download_file(session: requests.Session, info: FileInfo) -> bool:
-    """The function to download data and save file, used in `download_manga`."""
+    """The function to download data and save file, used in `download_manga`.
+
+    Data is written to a `.part` file first, so that `info.file` only exists once
+    it is complete.
+    """
+    part = info.file.with_name(info.file.name + ".part")
     try:
-        headers = session.headers
-        headers["Referer"] = "https://mangabz.com/"
-        response = requests.get(info.url, cookies=session.cookies, headers=headers)
-        response.raise_for_status()
-        info.file.write_bytes(response.content)
+        with session.get(info.url, stream=True) as response:
+            response.raise_for_status()
+            # Write chunks to the file descriptor directly, there is no need for
+            # another layer of buffering.
+            fd = os.open(
+                part,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                0o644,
+            )
+            size = 0
+            try:
+                for chunk in response.raw.stream(1 << 16, decode_content=True):
+                    size += len(chunk)
+                    # os.write may write less than it is given
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(fd, view) :]
+            finally:
+                os.close(fd)
+            # Older urllib3 does not notice a connection closed in the middle of
+            # the body, check it here so a truncated image is never kept.
+            length = response.headers.get("Content-Length")
+            encoding = response.headers.get("Content-Encoding", "identity")
+            if length is not None and encoding == "identity" and size != int(length):
+                raise RuntimeError(f"expect {length} bytes, but got {size}")
+        os.replace(part, info.file)
         return True
     except Exception:
-        if info.file.exists():
-            os.remove(info.file)
+        if part.exists():
+            os.remove(part)
         return False
 
 
+def _fetch_image_urls(
+    session: requests.Session, href: str, params: dict[str, str], page: int
+) -> list[str]:
+    """Get image urls of a chapter starting from `page`, used in `download_manga`."""
+    code = session.get(
+        f"https://mangabz.com/{href}/chapterimage.ashx",
+        params={**params, "page": page},
+    )
+    code.raise_for_status()
+    # Without a charset, requests would guess the encoding from the whole payload
+    code.encoding = "utf-8"
+    return _resolve_image_urls(code.text)
+
+
+def _resolve_image_urls(code: str) -> list[str]:
+    """Unpack code and build image urls, used in `download_manga`."""
+    unpack_code = unpack(code)
+    match = _PIX_SUFFIX_RE.search(unpack_code)
+    if match is None:
+        raise RuntimeError("cannot find image urls in chapterimage.ashx response")
+    pix, suffix = match["pix"], match["suffix"]
+    return [f"{pix}{p}{suffix}" for p in _PVALUE_RE.findall(unpack_code)]
+
+
 def download_manga(
     session: requests.Session,
     info: MangaInfo,
@@ -355,66 +292,106 @@ def download_manga(
     """Parallel download manga and save it in a specific directory."""
     response = session.get(f"https://mangabz.com/{info.chapters[index].href}/")
     response.raise_for_status()
-    mid = find_mangabz_var("COMIC_MID", response.text)
-    cid = find_mangabz_var("MANGABZ_CID", response.text)
-    viewsign = find_mangabz_var("MANGABZ_VIEWSIGN", response.text)
-    viewsign_dt = find_mangabz_var("MANGABZ_VIEWSIGN_DT", response.text)
-    total_pages = int(find_mangabz_var("MANGABZ_IMAGE_COUNT", response.text))
+    response.encoding = "utf-8"
+    mangabz_vars = find_mangabz_vars(response.text)
+    mid = mangabz_vars["COMIC_MID"]
+    cid = mangabz_vars["MANGABZ_CID"]
+    viewsign = mangabz_vars["MANGABZ_VIEWSIGN"]
+    viewsign_dt = mangabz_vars["MANGABZ_VIEWSIGN_DT"]
+    total_pages = int(mangabz_vars["MANGABZ_IMAGE_COUNT"])
 
-    print(f"resolving image urls of chapter {info.chapters[index].title!r}...")
     if is_chapter:
         save_dir = output_dir / Path(info.title)
     else:
         save_dir = output_dir / Path(info.title) / info.chapters[index].title
-    save_dir.mkdir(parents=True, exist_ok=True)
-    file_lists: list[FileInfo] = []
     num_width = len(str(total_pages))
-    now_page = 0
-    bar = tqdm(total=total_pages, unit="url")
-    while now_page < total_pages:
-        code = session.get(
-            f"https://mangabz.com/{info.chapters[index].href}/chapterimage.ashx",
-            params={
-                "cid": cid,
-                "page": now_page + 1,
-                "key": "",
-                "_cid": cid,
-                "_mid": mid,
-                "_dt": viewsign_dt,
-                "_sign": viewsign,
-            },
-            headers={"Referer": f"https://mangabz.com/{info.chapters[index].href}/"},
+    if all(
+        (save_dir / "{0:0{width}}.jpg".format(n + 1, width=num_width)).exists()
+        for n in range(total_pages)
+    ):
+        print(f"chapter {info.chapters[index].title!r} already downloaded, skipped")
+        return
+
+    print(f"resolving image urls of chapter {info.chapters[index].title!r}...")
+    save_dir.mkdir(parents=True, exist_ok=True)
+    params = {
+        "cid": cid,
+        "key": "",
+        "_cid": cid,
+        "_mid": mid,
+        "_dt": viewsign_dt,
+        "_sign": viewsign,
+    }
+    session.headers["Referer"] = f"https://mangabz.com/{info.chapters[index].href}/"
+    bar = tqdm(total=total_pages, unit="url", mininterval=0.2)
+    # The size of a batch is only known after the first request, the remaining
+    # pages can then be requested at the same time.
+    urls = _fetch_image_urls(session, info.chapters[index].href, params, 1)
+    batch = len(urls)
+    if batch == 0:
+        raise RuntimeError(f"no image found in {info.chapters[index].title!r}")
+    bar.update(batch)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            page: executor.submit(
+                _fetch_image_urls, session, info.chapters[index].href, params, page
+            )
+            for page in range(batch + 1, total_pages + 1, batch)
+        }
+        for f in as_completed(futures.values()):
+            bar.update(len(f.result()))
+    # Batches are assumed to have the same size, only keep them while the pages
+    # they start from line up with the urls collected so far.
+    for page, f in sorted(futures.items()):
+        if page != len(urls) + 1:
+            break
+        urls.extend(f.result())
+    bar.n = len(urls)
+    bar.refresh()
+    # Request the rest one batch after another if the batch size has changed
+    while len(urls) < total_pages:
+        page_urls = _fetch_image_urls(
+            session, info.chapters[index].href, params, len(urls) + 1
         )
-        code.raise_for_status()
-        unpack_code = unpack(code.text)
-        pix = re.search(r'pix="(.*?)"', unpack_code).group(1)
-        suffix = re.search(r"pix\+pvalue\[i\]\+'(.*?)'", unpack_code).group(1)
-        pvalue = re.findall(r'"(/.*?\.jpg)"', unpack_code)
-        for url in [(pix + p + suffix) for p in pvalue]:
-            now_page += 1
-            save_file = save_dir / "{0:0{width}}.jpg".format(now_page, width=num_width)
-            file_lists.append(FileInfo(url, save_file))
-            bar.update(1)
+        if len(page_urls) == 0:
+            break
+        urls.extend(page_urls)
+        bar.update(len(page_urls))
     bar.close()
+    if len(urls) != total_pages:
+        raise RuntimeError(
+            f"expect {total_pages} images in {info.chapters[index].title!r}, "
+            + f"but got {len(urls)}"
+        )
+    file_lists = [
+        FileInfo(url, save_dir / "{0:0{width}}.jpg".format(n + 1, width=num_width))
+        for n, url in enumerate(urls)
+    ]
+    # Files from a previous run are complete, see `_download_file`
+    pending = [item for item in file_lists if not item.file.exists()]
+    skipped = len(file_lists) - len(pending)
+    file_lists = pending
 
     print(f"downloading chapter {info.chapters[index].title!r}...")
+    session.headers["Referer"] = "https://mangabz.com/"
     success, failure = 0, 0
     with (
         ThreadPoolExecutor(max_workers=max_workers) as executor,
-        tqdm(total=len(file_lists), unit="file") as pbar,
+        tqdm(total=len(file_lists), unit="file", mininterval=0.2) as pbar,
     ):
         futures = {
             executor.submit(_download_file, session, item): item for item in file_lists
         }
         for f in as_completed(futures):
-            if f.result:
+            if f.result():
                 success += 1
             else:
                 failure += 1
             pbar.update(1)
     print(
         f"chapter {info.chapters[index].title!r} downloaded, "
-        + f"{success} success and {failure} {'failure' if failure <= 1 else 'failures'}"
+        + f"{success} success, {skipped} skipped and {failure} "
+        + f"{'failure' if failure <= 1 else 'failures'}"
     )
 
 
@@ -495,6 +472,17 @@ def main() -> int:
         raise RuntimeError(f"no such file or directory: {args.output_dir!r}")
 
     session = requests.Session()
+    # Keep as many idle connections as there are threads, so that none of them
+    # has to be established again for the next image.
+    adapter = TimeoutHTTPAdapter(
+        timeout=(5, 30),
+        pool_maxsize=args.threads,
+        max_retries=Retry(
+            total=5, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504]
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     session.headers["User-Agent"] = choice(user_agents)
     if args.language == "zh_tra":
         session.cookies["mangabz_lang"] = "1"
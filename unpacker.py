@@ -0,0 +1,179 @@
+# MIT License
+#
+# Copyright (c) 2025 zhengxyz123
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Decode javascript packed by P.A.C.K.E.R.
+
+Everything here is pure Python with full type annotations, so the module can be
+compiled with mypyc. `mangabz-dl.py` works the same with either of them.
+"""
+
+import re
+from typing import Callable
+
+# Unpacker for Dean Edward's p.a.c.k.e.r, a part of javascript beautifier
+# by Einar Lielmanis <einar@beautifier.io>
+# written by Stefano Sanfilippo <a.little.coder@gmail.com>
+
+_PACKER_HEADER_RE = re.compile(
+    r"eval[ ]*\([ ]*function[ ]*\([ ]*p[ ]*,[ ]*a[ ]*,[ ]*c["
+    " ]*,[ ]*k[ ]*,[ ]*e[ ]*,[ ]*"
+)
+_JUICERS = [
+    re.compile(juicer, re.DOTALL)
+    for juicer in (
+        r"}\('(.*)', *(\d+|\[\]), *(\d+), *'(.*)'\.split\('\|'\), *(\d+), *(.*)\)\)",
+        r"}\('(.*)', *(\d+|\[\]), *(\d+), *'(.*)'\.split\('\|'\)",
+    )
+]
+_STRTAB_RE = re.compile(r'var *(_\w+)\=\["(.*?)"\];', re.DOTALL)
+_WORD_RE = re.compile(r"(\b\w+\b)", re.ASCII)
+
+
+class UnpackingError(Exception):
+    """Badly packed source or general error. Argument is a meaningful description."""
+
+    pass
+
+
+def unpack(source: str) -> str:
+    """Unpack P.A.C.K.E.R packed js code."""
+    mystr = _PACKER_HEADER_RE.search(source)
+    if not mystr:
+        raise UnpackingError("not a P.A.C.K.E.R code")
+
+    begin_offset = mystr.start()
+    beginstr = source[:begin_offset]
+    source_end = source[begin_offset:]
+    if source_end.split("')))", 1)[0] == source_end:
+        try:
+            endstr = source_end.split("}))", 1)[1]
+        except IndexError:
+            endstr = ""
+    else:
+        endstr = source_end.split("')))", 1)[1]
+    payload, symtab, radix, count = _filterargs(source)
+
+    if count != len(symtab):
+        raise UnpackingError("malformed P.A.C.K.E.R symtab")
+
+    try:
+        unbase = Unbaser(radix)
+    except TypeError:
+        raise UnpackingError("unknown P.A.C.K.E.R encoding")
+
+    payload = payload.replace("\\\\", "\\").replace("\\'", "'")
+    # Words are at odd indexes after splitting, look up symbols in the synthetic
+    # symtab once for each distinct word.
+    parts = _WORD_RE.split(payload)
+    words: dict[str, str] = {}
+    for i in range(1, len(parts), 2):
+        word = parts[i]
+        if word not in words:
+            words[word] = symtab[unbase(word)] or word
+        parts[i] = words[word]
+    source = "".join(parts)
+    return _replacestrings(source, beginstr, endstr)
+
+
+def _filterargs(source: str) -> tuple[str, list[str], int, int]:
+    """Juice from a source file the four args needed by decoder."""
+    for juicer in _JUICERS:
+        args = juicer.search(source)
+        if args:
+            a = args.groups()
+            radix = "62" if a[1] == "[]" else a[1]
+            try:
+                return a[0], a[3].split("|"), int(radix), int(a[2])
+            except ValueError:
+                raise UnpackingError("corrupted P.A.C.K.E.R data")
+
+    # Could not find a satisfying regex
+    raise UnpackingError(
+        "could not make sense of P.A.C.K.E.R data (unexpected code structure)"
+    )
+
+
+def _replacestrings(source: str, beginstr: str, endstr: str) -> str:
+    """Strip string lookup table (list) and replace values in source."""
+    match = _STRTAB_RE.search(source)
+
+    if match:
+        varname, strings = match.groups()
+        startpoint = len(match.group(0))
+        lookup = strings.split('","')
+
+        def replace(match: re.Match[str]) -> str:
+            """Look up a value in the string table."""
+            index = int(match.group(1))
+            if index < len(lookup):
+                return '"%s"' % lookup[index]
+            return match.group(0)
+
+        variable = re.compile(r"%s\[(\d+)\]" % re.escape(varname))
+        return variable.sub(replace, source)[startpoint:]
+    return beginstr + source + endstr
+
+
+class Unbaser(object):
+    """Functor for a given base. Will efficiently convert strings to natural numbers."""
+
+    ALPHABET: dict[int, str] = {
+        62: "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ",
+        95: (
+            " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+            "[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~"
+        ),
+    }
+
+    def __init__(self, base: int) -> None:
+        self.base = base
+        self.unbase: Callable[[str], int]
+        self.dictionary: dict[str, int] = {}
+
+        # Fill elements 37...61, if necessary
+        if 36 < base < 62:
+            if not hasattr(self.ALPHABET, self.ALPHABET[62][:base]):
+                self.ALPHABET[base] = self.ALPHABET[62][:base]
+        # If base can be handled by int() builtin, let it do it for us
+        if 2 <= base <= 36:
+            self.unbase = lambda string: int(string, base)
+        else:
+            # Build conversion dictionary cache
+            try:
+                self.dictionary = dict(
+                    (cipher, index) for index, cipher in enumerate(self.ALPHABET[base])
+                )
+            except KeyError:
+                raise TypeError("unsupported base encoding")
+
+            self.unbase = self._dictunbaser
+
+    def __call__(self, string: str) -> int:
+        return self.unbase(string)
+
+    def _dictunbaser(self, string: str) -> int:
+        """Decode a value to an integer."""
+        ret = 0
+        for cipher in string:
+            ret = ret * self.base + self.dictionary[cipher]
+        return ret
+